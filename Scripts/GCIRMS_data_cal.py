@@ -30,36 +30,41 @@ def GCIRMS_data_cal(directory=os.getcwd(), pame=False):
     # Query isotope system
     isotope = isotope_type()
     project_name = query_project_name()
-    folder_path, fig_path, results_path, loc, log_file_path = create_folder(project_name, isotope, directory)
+    folder_path, fig_path, results_path, loc, logger = create_folder(project_name, isotope, directory)
 
-    lin_std, drift_std, samples, correction_log = import_data(loc, folder_path, log_file_path, isotope=isotope)
-    uncorrected_samples = samples.copy()
+    # Other modules log by path; append_to_log routes those entries through the open logger
+    log_file_path = logger.log_file_path
 
-    # Run standard plots for area
-    std_plot(lin_std, drift_std, folder_path=folder_path, fig_path=fig_path, isotope=isotope)
+    with logger:
+        lin_std, drift_std, samples, correction_log = import_data(loc, folder_path, logger, isotope=isotope)
+        logger.flush()
+        uncorrected_samples = samples.copy()
 
-    # Drift Correction
-    samples, lin_std, drift_std, dD_temp, correction_log = process_drift_correction(samples, lin_std, drift_std, correction_log, log_file_path=log_file_path, fig_path=fig_path, isotope=isotope)
+        # Run standard plots for area
+        std_plot(lin_std, drift_std, folder_path=folder_path, fig_path=fig_path, isotope=isotope)
 
-    # Show plots again
-    std_plot(lin_std, drift_std, folder_path=folder_path, fig_path=fig_path, dD=dD_temp, isotope=isotope)
+        # Drift Correction
+        samples, lin_std, drift_std, dD_temp, correction_log = process_drift_correction(samples, lin_std, drift_std, correction_log, log_file_path=log_file_path, fig_path=fig_path, isotope=isotope)
 
-    # Linearity (area) correction
-    drift_std, correction_log, lin_std, samples = process_linearity_correction(samples, drift_std, lin_std, dD_temp, correction_log, folder_path, fig_path, isotope, log_file_path=log_file_path)
+        # Show plots again
+        std_plot(lin_std, drift_std, folder_path=folder_path, fig_path=fig_path, dD=dD_temp, isotope=isotope)
 
-    # VSMOW correction
-    samples, standards = vsmow_correction(samples, lin_std, drift_std, correction_log, folder_path, fig_path, log_file_path, isotope)
+        # Linearity (area) correction
+        drift_std, correction_log, lin_std, samples = process_linearity_correction(samples, drift_std, lin_std, dD_temp, correction_log, folder_path, fig_path, isotope, log_file_path=log_file_path)
 
-    # Methylation Correction
-    if isotope == "dD":
-        samples, standards = q_methylation(samples, standards, log_file_path)
+        # VSMOW correction
+        samples, standards = vsmow_correction(samples, lin_std, drift_std, correction_log, folder_path, fig_path, log_file_path, isotope)
 
-    # Remove outliers
-    samples, excluded_samples = outlier_removal(samples, fig_path, log_file_path)
-    raw_samples = samples
+        # Methylation Correction
+        if isotope == "dD":
+            samples, standards = q_methylation(samples, standards, log_file_path)
 
-    # Calculate mean values of replicate analyses
-    samples = mean_values_with_uncertainty(samples, sample_name_header="Identifier 1", chain_header="chain")
+        # Remove outliers
+        samples, excluded_samples = outlier_removal(samples, fig_path, log_file_path)
+        raw_samples = samples
 
-    # Final Data Correction and Plot
-    output_results(raw_samples, samples, standards, folder_path, fig_path, results_path, isotope)
+        # Calculate mean values of replicate analyses
+        samples = mean_values_with_uncertainty(samples, sample_name_header="Identifier 1", chain_header="chain")
+
+        # Final Data Correction and Plot
+        output_results(raw_samples, samples, standards, folder_path, fig_path, results_path, isotope)
@@ -3,59 +3,103 @@ from datetime import datetime, timedelta
 import time
 import os
 import numpy as np
-from matplotlib.dates import date2num
 from queries import *
 
 
 def make_correction_df():
-    correction_log_data = {
-        "type": ["Drift", "Linearity", "VSMOW", "Methylation"],
-        "sample": [0, 0, 0, 0],  # Default values
-    }
-    correction_log = pd.DataFrame(correction_log_data)
-    correction_log = correction_log.set_index(["type"])
-    return correction_log
-
-
-def try_parse_date(date_str):
-    # List of date formats to try
-    formats = ["%m/%d/%Y %H:%M:%S", "%m/%d/%y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S"]
-
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt)
-        except ValueError:
-            continue
-    return None  # Return None if all formats fail
+    return pd.DataFrame({"sample": [0, 0, 0, 0]}, index=pd.Index(["Drift", "Linearity", "VSMOW", "Methylation"], name="type"))  # Default values
+
+
+# Chain lengths that can be identified; also the categories of the chain column
+chain_lengths = ["C16", "C18", "C20", "C22", "C24", "C26", "C28", "C30", "C32"]
+
+# Date formats written by the GC-IRMS software, in order of preference
+date_formats = ["%m/%d/%Y %H:%M:%S", "%m/%d/%y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S"]
+
+
+def parse_date_time(df):
+    """
+    Combine the Date and Time columns and parse them with pd.to_datetime, one format at a time.
+    Rows that fail a format are retried with the next one; rows that fail every format are NaT.
+    """
+    concat = df["Date"].astype(str).str.cat(df["Time"].astype(str), sep=" ")
+    parsed = pd.to_datetime(concat, format=date_formats[0], errors="coerce")
+    for fmt in date_formats[1:]:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed = parsed.fillna(pd.to_datetime(concat[missing], format=fmt, errors="coerce"))
+    return parsed
+
+
+# Loggers currently open, by log file path
+_open_loggers = {}
+
+
+class Logger:
+    """
+    Log file kept open for the whole run, so entries are written without reopening the file.
+    Use as a context manager so the file is closed even if the run fails.
+    """
+
+    def __init__(self, log_file_path, mode="a"):
+        # Close a handle left open on the same file by an interrupted run
+        if log_file_path in _open_loggers:
+            _open_loggers[log_file_path].close()
+        self.log_file_path = log_file_path
+        self.log_file = open(log_file_path, mode)
+        _open_loggers[log_file_path] = self
+
+    def write(self, text):
+        self.log_file.write(text)
+
+    def log(self, log_message):
+        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.write(log_message + "; " + str(current_datetime) + "\n")
+
+    def flush(self):
+        self.log_file.flush()
+
+    def close(self):
+        if _open_loggers.get(self.log_file_path) is self:
+            del _open_loggers[self.log_file_path]
+        self.log_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def create_log_file(folder_path):
     """
-    Create log file.
+    Create log file and return a Logger writing to it.
     """
     # Ensure the folder exists
     os.makedirs(folder_path, exist_ok=True)
     # Create the full path for the log file
     log_file_path = os.path.join(folder_path, "Log file.txt")
     # Create the log file and write the initial message
-    with open(log_file_path, "w") as log_file:
-        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        initial_message = "Log file created at " + str(current_datetime) + "\n"
-        log_file.write(initial_message)
-    return log_file_path
+    logger = Logger(log_file_path, mode="w")
+    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logger.write("Log file created at " + str(current_datetime) + "\n")
+    return logger
 
 
 def append_to_log(log_file_path, log_message):
     """
-    Add entry to log file.
+    Add entry to log file. Entries go through the open Logger for the file if there is one.
     """
+    if log_file_path in _open_loggers:
+        _open_loggers[log_file_path].log(log_message)
+        return
     with open(log_file_path, "a") as log_file:
         current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        initial_message = f"Log file created at {current_datetime}\n"
         log_file.write(log_message + "; " + str(current_datetime) + "\n")
 
 
-def import_data(data_location, folder_path, log_file_path, isotope):
+def import_data(data_location, folder_path, logger, isotope):
     """
     Import .csv file from GCIRMs - default .csv file from GCIRMS creates issues with header. The function assigns new header names,
     creates a date-time format for linear regression, identifieds standards, and isolates standards and samples.
@@ -66,71 +110,79 @@ def import_data(data_location, folder_path, log_file_path, isotope):
         unknown        - dataframe with sample data
     ~GAO~ 12/4/2023
     """
-    # Create log file
-
-    df = pd.read_csv(data_location)
-    new_name = [str(isotope), "area", "chain"]
-    x = 0
     if isotope == "dD":
         iso_rat = "d 2H/1H"
     if isotope == "dC":
         iso_rat = "d 13C/12C"
-    for name in [str(iso_rat), "Area All", "Component"]:
-        if name in df.columns:
-            df = df.rename(columns={df.columns[df.columns.str.contains(name)][0]: new_name[x]})
-            x = x + 1
+    df = pd.read_csv(data_location, dtype={"Identifier 1": "string", "Date": str, "Time": str, "Component": "category", "Rt": "float32"})
+    new_name = [str(isotope), "area", "chain"]
+    for name, new in zip([str(iso_rat), "Area All", "Component"], new_name):
+        match = next((col for col in df.columns if name in col), None)
+        if match is not None:
+            df.rename(columns={match: new}, inplace=True)
         else:
             print(name)
-            df[name] = pd.NA
+            df[new] = pd.NA
+    df["chain"] = pd.Categorical(df["chain"], categories=chain_lengths)
     # df['date-time_true'] = pd.to_datetime(df['Date'] + ' ' + df['Time'], format='%m/%d/%y %H:%M:%S')
-    df["date-time_true"] = df.apply(lambda row: try_parse_date(row["Date"] + " " + row["Time"]), axis=1)
-    df["date-time"] = date2num(df["date-time_true"])
-    df["time_rel"] = df["date-time"] - df["date-time"].max()
+    df["date-time_true"] = parse_date_time(df)
+    # Nanoseconds since epoch (missing where the date could not be parsed); time relative to the last run in days
+    date_time_ns = df["date-time_true"].to_numpy(dtype="datetime64[ns]").view("int64")
+    df["date-time"] = pd.Series(date_time_ns, index=df.index, dtype="Int64").mask(df["date-time_true"].isna())
+    df["time_rel"] = (df["date-time_true"] - df["date-time_true"].max()) / pd.Timedelta(days=1)
 
     # Seperate samples, H3+, drift, and linearity standards
-    linearity_std = df[df["Identifier 1"].str.contains("C20") & df["Identifier 1"].str.contains("C28")]  # Isolate linearity standards
+    # Scan the identifiers once per pattern and reuse the masks
+    ids = df["Identifier 1"].astype("string")
+    m_c18 = ids.str.contains("C18", regex=False, na=False)
+    m_c20 = ids.str.contains("C20", regex=False, na=False)
+    m_c24 = ids.str.contains("C24", regex=False, na=False)
+    m_c28 = ids.str.contains("C28", regex=False, na=False)
+    m_h3 = ids.str.contains("H3+", regex=False, na=False)
+    lin_mask = m_c20 & m_c28
+    drift_mask = m_c18 & m_c24
+
+    linearity_std = df[lin_mask]  # Isolate linearity standards
     linearity_std = linearity_std[linearity_std.chain.isin(["C20", "C28"])]
-    append_to_log(log_file_path, "Number of linearity standards analyzed: " + str(len(linearity_std[linearity_std.chain == "C28"])))
+    logger.log("Number of linearity standards analyzed: " + str(len(linearity_std[linearity_std.chain == "C28"])))
 
-    drift_std = df[df["Identifier 1"].str.contains("C18") & df["Identifier 1"].str.contains("C24")]  # Isolate drift standards
+    drift_std = df[drift_mask]  # Isolate drift standards
     drift_std = drift_std[drift_std.chain.isin(["C18", "C24"])]
-    append_to_log(log_file_path, "Number of Drift standards analyzed: " + str(len(drift_std[drift_std.chain == "C24"])))
+    logger.log("Number of Drift standards analyzed: " + str(len(drift_std[drift_std.chain == "C24"])))
 
     # Remove first two drift runs
-    drift_std = drift_std.sort_values("date-time_true")
-    unique_time_signatures = drift_std["date-time"].unique()  # identify unique drift runs
-    # time_signatures_to_remove = unique_time_signatures[6:] # find time signature of first two runs
-    time_signatures_to_remove = unique_time_signatures[:2]  # Modified Jan 7, 2024 - line above is original method, but didnt work?
-    drift_std = drift_std[~drift_std["date-time"].isin(time_signatures_to_remove)]  # Remove first two runs - OSIBL ignores for variance
-    append_to_log(log_file_path, "First two drift standards ignored.")
-    mask = df["Identifier 1"].str.contains("C18") & df["Identifier 1"].str.contains("C24")
-    unknown = df[~mask]
-    mask = unknown["Identifier 1"].str.contains("C20") & unknown["Identifier 1"].str.contains("C28")
-    unknown = unknown[~mask]
-    unknown = unknown[~unknown["Identifier 1"].str.contains("H3+")]
-    rt_dict = ask_user_for_rt(log_file_path)
+    # Find the time signatures of the two earliest drift runs without sorting the frame
+    time_signatures = drift_std["date-time"].to_numpy(dtype="int64", na_value=0)
+    valid = time_signatures[drift_std["date-time"].notna().to_numpy()]
+    time_signatures_to_remove = []
+    if len(valid) > 0:
+        first = valid.min()
+        later = valid[valid != first]
+        time_signatures_to_remove = [first] if len(later) == 0 else [first, later.min()]
+    drift_std = drift_std[~np.isin(time_signatures, time_signatures_to_remove)]  # Remove first two runs - OSIBL ignores for variance
+    logger.log("First two drift standards ignored.")
+    unknown = df.loc[~(lin_mask | drift_mask | m_h3)].copy()
+    rt_dict = ask_user_for_rt(logger)
     if rt_dict:
-        unknown = process_dataframe(unknown, rt_dict, folder_path)
-        unknown = unknown[unknown.chain != "None"]
-        linearity_std = process_dataframe(linearity_std, rt_dict, folder_path)
-        drift_std = process_dataframe(drift_std, rt_dict, folder_path)
-    else:
-        unknown = unknown[unknown.chain.isin(["C16", "C18", "C20", "C22", "C24", "C24", "C26", "C28", "C30", "C32"])]
-    for i in [unknown, drift_std, linearity_std]:
-        i = i[~i.chain.isna()]
+        unknown = process_dataframe(unknown, rt_dict, folder_path, logger)
+        linearity_std = process_dataframe(linearity_std, rt_dict, folder_path, logger)
+        drift_std = process_dataframe(drift_std, rt_dict, folder_path, logger)
+    linearity_std = linearity_std[linearity_std.chain.notna()]
+    drift_std = drift_std[drift_std.chain.notna()]
+    unknown = unknown[unknown.chain.notna()]
     correction_log = make_correction_df()
     return linearity_std, drift_std, unknown, correction_log
 
 
 def create_folder(name, isotope, dir=os.getcwd()):
     folder_path = os.path.join(dir, name)
-    log_file_path = create_log_file(folder_path)
+    logger = create_log_file(folder_path)
     if isotope == "dD":
         iso_name = "δD"
     else:
         iso_name = "δC"
-    append_to_log(log_file_path, "Isotope type: " + str(iso_name))
-    os.makedirs(folder_path, exist_ok=True)
+    logger.log("Isotope type: " + str(iso_name))
+    logger.flush()
 
     # Make output folders
     fig_path = os.path.join(folder_path, "Figures")
@@ -139,9 +191,13 @@ def create_folder(name, isotope, dir=os.getcwd()):
     results_path = os.path.join(folder_path, "Results")
     os.makedirs(results_path, exist_ok=True)
 
-    locate = query_file_location()  # Location of file
+    try:
+        locate = query_file_location()  # Location of file
+    except BaseException:
+        logger.close()
+        raise
 
-    return folder_path, fig_path, results_path, locate, log_file_path
+    return folder_path, fig_path, results_path, locate, logger
 
 
 def create_subfolder(folder_path, name):
@@ -150,24 +206,33 @@ def create_subfolder(folder_path, name):
     return subf_path
 
 
-def closest_rt(df, time_val, target_rt, threshold=0.05):
+def closest_rt(rt_arr, targets, threshold=0.05):
     """
-    Find the closest retention time(s) to the target.
-    If two values are almost equally close (within a threshold), return both.
+    Find the closest retention time(s) to every target within a single sample.
+    Distances are computed once as a (peaks x targets) matrix.
+    Outputs:
+        nearest - positions of the two closest peaks per target (2 x targets)
+        both    - True where the two peaks are almost equally close (within a threshold)
+        found   - False where the sample has no retention time to match
     """
-    sample_df = df[df["Time"] == time_val]
-    differences = (sample_df["Rt"] - target_rt).abs()
-    min_diff = differences.min()
-    closest_rows = sample_df[differences <= min_diff * (1 + threshold)]
-    return closest_rows
+    distances = np.abs(rt_arr[:, None] - targets[None, :])
+    cols = np.arange(len(targets))
+    if len(rt_arr) < 2:
+        nearest = np.zeros((2, len(targets)), dtype=np.intp)
+        both = np.zeros(len(targets), dtype=bool)
+    else:
+        # Missing retention times are partitioned last
+        nearest = np.argpartition(distances, 1, axis=0)[:2]
+        both = distances[nearest[1], cols] <= distances[nearest[0], cols] * (1 + threshold)
+    found = ~np.isnan(distances[nearest[0], cols])
+    return nearest, both, found
 
 
-def ask_user_for_rt(log_file_path):
-    chain_lengths = ["C16", "C18", "C20", "C22", "C24", "C26", "C28", "C30", "C32"]
+def ask_user_for_rt(logger):
     while True:
         response = input("Do you want to detect components in this dataset by retention time? (Y/N):\n").strip().lower()
         if pos_response(response):
-            append_to_log(log_file_path, "User opted to identify chains.")
+            logger.log("User opted to identify chains.")
             rt_values = input("Enter retention times for " + ", ".join(chain_lengths) + " separated by commas (type 'none' for any you don't want to use):\n")
             rt_values = rt_values.split(",")
             if len(rt_values) == len(chain_lengths):
@@ -176,72 +241,105 @@ def ask_user_for_rt(log_file_path):
             else:
                 print("Invalid input. Please provide the correct number of values.\n")
         elif neg_response(response):
-            append_to_log(log_file_path, "User opted not to identify chains.")
+            logger.log("User opted not to identify chains.")
             print("Component detection not selected.\n")
             return None
         else:
             print("Invalid response. Please answer 'yes' or 'no'.\n")
 
 
-def process_dataframe(df, rt_dict, folder_path, log_file_path):
+def plot_rt_matches(sample_df, closest_rows, sample_id, time_val, chain, rt, rt_path):
+    """
+    Plot the chromatogram of a sample with the peaks closely matching a target retention time numbered.
+    Saved at screen resolution with light PNG compression; only drawn when the user has to choose.
+    """
+    plt.figure()
+    plt.scatter(sample_df["Rt"], sample_df["area"], label=sample_id, color="red", ec="k")
+    plt.plot(sample_df["Rt"], sample_df["area"], label=sample_id, linestyle="--", c="k")
+    x = 0
+    lim = -999
+    for index, (_, row) in enumerate(closest_rows.iterrows(), start=1):
+        if x == 0:
+            lim = row["Rt"]
+        plt.axvline(x=row["Rt"], color="red", linestyle="--", alpha=0.5)
+        plt.text(row["Rt"], sample_df["area"].mean() + x, str(index), color="k", fontsize=12, verticalalignment="bottom")
+        x = x + 5
+    plt.xlabel("Retention Time")
+    plt.ylabel("Area")
+    plt.title(f"Close Matches for {sample_id} ({time_val}) - {chain}")
+    if lim != -999:
+        if lim > row["Rt"]:
+            x_min = row["Rt"] - 50
+            x_max = lim + 50
+        else:
+            x_min = lim - 50
+            x_max = row["Rt"] + 50
+    else:
+        x_min = 450
+        x_max = row["Rt"] + 50
+    plt.xlim(x_min, x_max)
+    plt.legend()
+    plt.savefig(os.path.join(rt_path, "Sample " + str(sample_id) + "Chain " + str(chain) + " rt " + str(rt) + ".png"), dpi=100, bbox_inches="tight", pil_kwargs={"compress_level": 1})
+    plt.show()
+    plt.close()
+
+
+def assign_chains(time_codes, rt_arr, targets, target_codes, threshold=0.05):
+    """
+    Match the peaks of every sample to the target retention times in a single pass over the data.
+    Rows are ordered by sample once and each sample is handled as a contiguous slice.
+    Outputs:
+        codes     - chain code assigned to each row (-1 if unassigned)
+        ambiguous - list of (target position, row positions) where several peaks are equally close
+    """
+    codes = np.full(len(rt_arr), -1, dtype=np.int8)
+    ambiguous = []
+    valid = np.flatnonzero(time_codes >= 0)
+    if len(valid) == 0:
+        return codes, ambiguous
+    order = valid[np.argsort(time_codes[valid], kind="stable")]
+    bounds = np.flatnonzero(np.diff(time_codes[order])) + 1
+    for group in np.split(order, bounds):
+        nearest, both, found = closest_rt(rt_arr[group], targets, threshold)
+        for j in np.flatnonzero(found):
+            if both[j]:
+                ambiguous.append((j, group[np.sort(nearest[:, j])]))
+            else:
+                # Only one clear closest match
+                codes[group[nearest[0, j]]] = target_codes[j]
+    return codes, ambiguous
+
+
+def process_dataframe(df, rt_dict, folder_path, logger):
     if rt_dict is None:
         return df
     rt_path = create_subfolder(folder_path, "Retention time figures")
-    df["chain"] = None
-    unique_times = df["Time"].unique()
-    for time_val in unique_times:
-        sample_id = df.loc[df["Time"] == time_val, "Identifier 1"].iloc[0]
-
-        # For 'standard' types, use chains mentioned in Identifier 1 or all chains if none are mentioned
-        filtered_rt_dict = rt_dict
-        for chain, rt in filtered_rt_dict.items():
-            if rt is not None:
-                closest_rows = closest_rt(df, time_val, rt)
-                if len(closest_rows) == 1:
-                    # Only one clear closest match
-                    correct_rt = closest_rows.iloc[0]["Rt"]
-                    df.loc[(df["Time"] == time_val) & (df["Rt"] == correct_rt), "chain"] = chain
-                elif len(closest_rows) > 1:
-                    # Two closely matched peaks, prompt the user
-                    clear_output(wait=True)
-                    plt.figure()
-                    sample_df = df[df["Time"] == time_val]
-                    plt.scatter(sample_df["Rt"], sample_df["Area All"], label=sample_id, color="red", ec="k")
-                    plt.plot(sample_df["Rt"], sample_df["Area All"], label=sample_id, linestyle="--", c="k")
-                    x = 0
-                    lim = -999
-                    for index, (_, row) in enumerate(closest_rows.iterrows(), start=1):
-                        if x == 0:
-                            lim = row["Rt"]
-                        plt.axvline(x=row["Rt"], color="red", linestyle="--", alpha=0.5)
-                        plt.text(row["Rt"], sample_df["Area All"].mean() + x, str(index), color="k", fontsize=12, verticalalignment="bottom")
-                        x = x + 5
-                    plt.xlabel("Retention Time")
-                    plt.ylabel("Area")
-                    plt.title(f"Close Matches for {sample_id} ({time_val}) - {chain}")
-                    if lim != -999:
-                        if lim > row["Rt"]:
-                            x_min = row["Rt"] - 50
-                            x_max = lim + 50
-                        else:
-                            x_min = lim - 50
-                            x_max = row["Rt"] + 50
-                    else:
-                        x_min = 450
-                        x_max = row["Rt"] + 50
-                    plt.xlim(x_min, x_max)
-                    plt.legend()
-                    plt.savefig(os.path.join(rt_path, "Sample " + str(sample_id) + "Chain " + str(chain) + " rt " + str(rt) + ".png"), dpi=300, bbox_inches="tight")
-                    plt.show()
-
-                    choice = input(f"Enter the number associated with the correct retention time for {chain} in sample {sample_id} ({time_val}), or type 'none' to skip:\n").strip().lower()
-                    if choice == "none":
-                        continue
-                    choice = int(choice)
-                    correct_rt = closest_rows.iloc[choice - 1]["Rt"]
-                    df.loc[(df["Time"] == time_val) & (df["Rt"] == correct_rt), "chain"] = chain
-                else:
-                    df.loc[closest_rows.index, "chain"] = chain
-    export_df = df[df["chain"].isin(["C16", "C18", "C20", "C22", "C24", "C26", "C28", "C30", "C32"])]
-    append_to_log(log_file_path, f"Chain lengths identified by user: {export_df.chain.unique()}")
+    active = [(chain, rt) for chain, rt in rt_dict.items() if rt is not None]
+    targets = np.array([rt for _, rt in active], dtype=np.float32)
+    target_codes = np.array([chain_lengths.index(chain) for chain, _ in active], dtype=np.int8)
+    time_codes, _ = pd.factorize(df["Time"])
+    codes, ambiguous = assign_chains(time_codes, df["Rt"].to_numpy(), targets, target_codes)
+    time_arr = df["Time"].to_numpy()
+    id_arr = df["Identifier 1"].to_numpy()
+
+    # Two closely matched peaks, prompt the user
+    for j, closest in ambiguous:
+        chain, rt = active[j]
+        closest_rows = df.iloc[closest]
+        time_val = time_arr[closest[0]]
+        sample_id = id_arr[closest[0]]
+        sample_df = df[time_codes == time_codes[closest[0]]]
+        clear_output(wait=True)
+        plot_rt_matches(sample_df, closest_rows, sample_id, time_val, chain, rt, rt_path)
+
+        choice = input(f"Enter the number associated with the correct retention time for {chain} in sample {sample_id} ({time_val}), or type 'none' to skip:\n").strip().lower()
+        if choice == "none":
+            continue
+        choice = int(choice)
+        # Chains are matched in increasing code order and a later chain takes the peak, so keep the larger code
+        pos = closest[choice - 1]
+        codes[pos] = max(codes[pos], target_codes[j])
+    df["chain"] = pd.Categorical.from_codes(codes, categories=chain_lengths)
+    export_df = df[df["chain"].notna()]
+    logger.log(f"Chain lengths identified by user: {export_df.chain.unique().tolist()}")
     return export_df
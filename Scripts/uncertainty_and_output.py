@@ -52,6 +52,7 @@ def output_results(raw_unknown, unknown, sd, folder_path, fig_path, res_path, is
         "Ampl  3": "Amplitude 3",
         "BGD 2": "Background 2",
         "BGD 3": "Background 3",
+        "date-time": "Date-time (ns since epoch)",
         "time_rel": "Time relative",
         "dD": f"Raw {isotope}",
         "drift_corrected_dD": f"Drift corrected {isotope}",
@@ -84,7 +85,7 @@ def output_results(raw_unknown, unknown, sd, folder_path, fig_path, res_path, is
 
 def mean_values_with_uncertainty(data, sample_name_header="Identifier 1", chain_header="chain"):
     # Group by sample name and chain length
-    grouped = data.groupby([sample_name_header, chain_header])
+    grouped = data.groupby([sample_name_header, chain_header], observed=True)
 
     # Calculate the mean values and count of replicates
     stats = grouped.agg(